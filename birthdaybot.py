@@ -2,76 +2,215 @@
 
 import os
 import ldap3
-from ldap3 import Server, Connection, ALL_ATTRIBUTES, Tls, SASL, EXTERNAL, SUBTREE
+from ldap3 import Server, Connection, Tls, SASL, EXTERNAL, SUBTREE
+from ldap3.utils.conv import escape_filter_chars
 import ssl
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from icalendar import Calendar
 import logging
-from datetime import datetime
+from datetime import date, datetime
 
 # Setup basic configuration for logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# LDAP settings are fixed for the lifetime of the process, so read them once
+LDAP_SERVER = os.getenv('LDAP_SERVER')
+SEARCH_BASE = os.getenv('SEARCH_BASE')
+LDAP_PRIVATE_KEY_FILE = '/app/certs/ldapcertificate.key'
+LDAP_CERTIFICATE_FILE = '/app/certs/ldapcertificate.crt'
+
+# Only the attributes verification reads; avoids pulling photos, certificates and group lists
+LDAP_ATTRIBUTES = ['uid', 'suspended']
+
+# Maximum number of uids OR-ed together in a single LDAP search filter
+LDAP_FILTER_CHUNK_SIZE = 500
+
+# Slack rejects messages with more than 50 blocks
+SLACK_MAX_BLOCKS = 50
+
+# RFC 5545 folds long content lines with a line break followed by a space or tab
+_ICS_FOLD_RE = re.compile(rb'\r?\n[ \t]')
+# A whole VEVENT block, from its BEGIN line to its END line
+_ICS_VEVENT_RE = re.compile(rb'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?$', re.MULTILINE | re.DOTALL | re.IGNORECASE)
+# TEXT values escape backslash, semicolon, comma and newline with a backslash
+_ICS_ESCAPE_RE = re.compile(rb'\\([\\;,nN])')
+
+def create_http_session():
+    # Retry connection failures and throttling/5xx responses; POSTs are only retried
+    # before the request is sent, so Slack never receives a duplicate message
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Shared session so the ICS download and Slack posts reuse pooled keep-alive connections
+http_session = create_http_session()
+
 def download_ics(ics_url):
     logging.info(f"Downloading ICS file from {ics_url}")
-    response = requests.get(ics_url)
-    response.raise_for_status()
+    # Stream so the headers can be checked before the body is downloaded
+    response = http_session.get(ics_url, stream=True)
+    try:
+        response.raise_for_status()
 
-    if 'text/calendar' not in response.headers.get('Content-Type', ''):
-        raise ValueError("Downloaded file is not an ICS file based on Content-Type header.")
+        if 'text/calendar' not in response.headers.get('Content-Type', ''):
+            raise ValueError("Downloaded file is not an ICS file based on Content-Type header.")
 
-    return response.content
+        return response.content
+    finally:
+        response.close()
 
 def get_events_for_date(ics_content, target_date):
     logging.info(f"Parsing the ICS file for events on {target_date}")
-    calendar = Calendar.from_ical(ics_content)
-    target_date_events = []
+    try:
+        events = list(iter_vevents(ics_content, target_date))
+    except ValueError as e:
+        logging.warning(f"Falling back to the icalendar parser: {e}")
+        events = list(iter_vevents_with_icalendar(ics_content))
+    full_names = []
 
-    for component in calendar.walk():
-        if component.name == "VEVENT":
-            event_start = component.get('dtstart').dt
-            event_start_date = event_start.date() if hasattr(event_start, 'date') else event_start
+    for event_start_date, event_summary in events:
+        if event_start_date != target_date or '-' not in event_summary:
+            continue
+        full_names.append(event_summary.partition('-')[0].strip())
 
-            if event_start_date == target_date:
-                event_summary = component.get('summary')
-                if '-' in event_summary:
-                    full_name = event_summary.split('-')[0].strip()
-                    if verify_person_in_ldap(full_name):
-                        message = f":birthday: Happy Birthday {full_name}! :tada:"
-                        target_date_events.append(message)
+    # Feeds can carry several VEVENTs for one person (series plus override); greet them once
+    full_names = list(dict.fromkeys(full_names))
 
-    return target_date_events
+    # Verify everyone in one LDAP search rather than one connection per event
+    active_names = verify_people_in_ldap(full_names)
+    return [f":birthday: Happy Birthday {full_name}! :tada:"
+            for full_name in full_names if full_name in active_names]
 
-def verify_person_in_ldap(full_name):
-    ldap_server = os.getenv('LDAP_SERVER')
-    search_base = os.getenv('SEARCH_BASE')
-    first_last = full_name.replace(' ', '.').lower()
-    search_filter = f"(uid={first_last})"
+# Yields (start_date, summary) for every VEVENT. Only DTSTART and SUMMARY are read, in a
+# single pass over the raw bytes; raises ValueError on anything it does not understand so
+# the caller can fall back to icalendar. With target_date, events that cannot start on that
+# date may be skipped, but callers must still compare the yielded dates.
+def iter_vevents(ics_content, target_date=None):
+    unfolded = _ICS_FOLD_RE.sub(b'', ics_content)
+    if target_date is not None:
+        # Any VEVENT starting on target_date has its YYYYMMDD in the DTSTART value, so blocks
+        # without those bytes are dropped by the C regex engine before any line parsing
+        needle = target_date.strftime('%Y%m%d').encode()
+        unfolded = b'\n'.join(block for block in _ICS_VEVENT_RE.findall(unfolded) if needle in block)
 
-    # Specify the client certificates explicitly
-    tls_configuration = Tls(local_private_key_file='/app/certs/ldapcertificate.key',
-                            local_certificate_file='/app/certs/ldapcertificate.crt',
-                            validate=ssl.CERT_NONE)  # Disabling certificate validation
+    in_event = False
+    nested = 0
+    for line in unfolded.splitlines():
+        name, value = _split_ics_line(line)
+        if name == b'BEGIN':
+            if in_event:
+                nested += 1
+            elif value.upper() == b'VEVENT':
+                in_event = True
+                dtstart = summary = None
+        elif name == b'END':
+            if nested:
+                nested -= 1
+            elif in_event and value.upper() == b'VEVENT':
+                in_event = False
+                if dtstart is not None:
+                    yield _parse_ics_date(dtstart), summary or ''
+        elif in_event and not nested:
+            if name == b'DTSTART':
+                dtstart = value
+            elif name == b'SUMMARY':
+                summary = _ICS_ESCAPE_RE.sub(_unescape_ics_text, value).decode('utf-8', 'replace')
 
-    server = Server(ldap_server, use_ssl=True, tls=tls_configuration)
+def iter_vevents_with_icalendar(ics_content):
+    calendar = Calendar.from_ical(ics_content)
+    for component in calendar.walk('VEVENT'):
+        dtstart = component.get('dtstart')
+        if dtstart is None:
+            continue
+        event_start = dtstart.dt
+        event_start_date = event_start.date() if hasattr(event_start, 'date') else event_start
+        yield event_start_date, str(component.get('summary') or '')
 
-    try:
-        conn = Connection(server, authentication=SASL, sasl_mechanism=EXTERNAL, auto_bind=True)
-        conn.search(search_base, search_filter, search_scope=SUBTREE, attributes=ALL_ATTRIBUTES)
-        if conn.entries:
-            entry = conn.entries[0]
-            suspended = entry.suspended.value if 'suspended' in entry else 'unknown'
-            conn.unbind()
-            return suspended.lower() == 'false'
+# Returns the upper-cased property name and the raw value of an unfolded content line
+def _split_ics_line(line):
+    if b'"' not in line:
+        head, _, value = line.partition(b':')
+    else:
+        # Parameter values may be quoted and contain ':' (e.g. ALTREP="http://...")
+        quoted = False
+        for i, char in enumerate(line):
+            if char == 0x22:
+                quoted = not quoted
+            elif char == 0x3A and not quoted:
+                head, value = line[:i], line[i + 1:]
+                break
         else:
-            logging.warning(f"No entries found for user {first_last}")
+            head, value = line, b''
+    return head.partition(b';')[0].strip().upper(), value
+
+# DTSTART is YYYYMMDD, optionally followed by THHMMSS[Z]. icalendar keeps the wall-clock
+# date in the event's own timezone, so the leading date digits are the date it reports.
+def _parse_ics_date(value):
+    value = value.strip()
+    if len(value) < 8 or not value[:8].isdigit() or value[8:9] not in (b'', b'T'):
+        raise ValueError(f"Unsupported DTSTART value: {value!r}")
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+def _unescape_ics_text(match):
+    char = match.group(1)
+    return b'\n' if char in b'nN' else char
+
+# Returns the subset of full_names that have an active (not suspended) LDAP entry
+def verify_people_in_ldap(full_names):
+    names_by_uid = {}
+    for full_name in full_names:
+        names_by_uid.setdefault(name_to_uid(full_name), []).append(full_name)
+    if not names_by_uid:
+        return set()
+
+    uids = list(names_by_uid)
+    suspended_by_uid = {}
+
+    try:
+        conn = Connection(get_ldap_server(), authentication=SASL, sasl_mechanism=EXTERNAL, auto_bind=True)
+        # Chunk the OR filter so it stays within server filter size limits
+        for i in range(0, len(uids), LDAP_FILTER_CHUNK_SIZE):
+            # Calendar summaries are untrusted: escape *, (, ), \ and NUL so a name can't widen the query
+            uid_filters = ''.join(f"(uid={escape_filter_chars(uid)})" for uid in uids[i:i + LDAP_FILTER_CHUNK_SIZE])
+            conn.search(SEARCH_BASE, f"(|{uid_filters})", search_scope=SUBTREE, attributes=LDAP_ATTRIBUTES)
+            for entry in conn.entries:
+                suspended = entry.suspended.value if 'suspended' in entry else 'unknown'
+                for uid in entry.uid.values if 'uid' in entry else []:
+                    suspended_by_uid.setdefault(str(uid).lower(), suspended)
     except Exception as e:
         logging.error(f"LDAP operation failed: {e}")
+        return set()
     finally:
         if 'conn' in locals() and conn.bound:
             conn.unbind()
 
-    return False
+    active_names = set()
+    for uid, names in names_by_uid.items():
+        if uid not in suspended_by_uid:
+            logging.warning(f"No entries found for user {uid}")
+        elif str(suspended_by_uid[uid]).lower() == 'false':
+            active_names.update(names)
+
+    return active_names
+
+# Canonical calendar name -> LDAP uid transform ("Jane Smith" -> "jane.smith")
+def name_to_uid(full_name):
+    return full_name.replace(' ', '.').lower()
+
+def get_ldap_server():
+    # Specify the client certificates explicitly
+    tls_configuration = Tls(local_private_key_file=LDAP_PRIVATE_KEY_FILE,
+                            local_certificate_file=LDAP_CERTIFICATE_FILE,
+                            validate=ssl.CERT_NONE)  # Disabling certificate validation
+
+    return Server(LDAP_SERVER, use_ssl=True, tls=tls_configuration)
 
 def parse_date(date_str):
     try:
@@ -100,14 +239,23 @@ def main():
         logging.info("No events found for the target date.")
 
 def post_to_slack(webhook_url, messages):
-    for message in messages:
-        data = {"text": message}
-        response = requests.post(webhook_url, json=data)
+    # One webhook call per batch of messages, each message its own Block Kit section
+    for i in range(0, len(messages), SLACK_MAX_BLOCKS):
+        batch = messages[i:i + SLACK_MAX_BLOCKS]
+        data = {
+            "text": "\n".join(batch),
+            "blocks": [{"type": "section", "text": {"type": "mrkdwn", "text": message}} for message in batch],
+        }
+        response = http_session.post(webhook_url, json=data)
         response.raise_for_status()
-        logging.info(f"Posted message to Slack: {message}")
+        for message in batch:
+            logging.info(f"Posted message to Slack: {message}")
 
 if __name__ == '__main__':
     logging.info("Starting the script...")
-    main()
+    try:
+        main()
+    finally:
+        http_session.close()
     logging.info("Script execution completed.")
 
@@ -1,27 +1,130 @@
-import os
 import unittest
-from unittest.mock import patch
-from birthdaybot import download_ics
+from datetime import date
+from unittest.mock import MagicMock, patch
+from birthdaybot import (download_ics, get_events_for_date, iter_vevents,
+                         iter_vevents_with_icalendar, post_to_slack, verify_people_in_ldap)
 
 class TestBirthdayBot(unittest.TestCase):
 
-    @patch('requests.get')
+    @patch('birthdaybot.http_session.get')
     def test_download_ics_with_valid_url(self, mock_get):
         # Mocking the response to simulate a valid ICS file
         mock_get.return_value.status_code = 200
         mock_get.return_value.headers = {'Content-Type': 'text/calendar'}
         mock_get.return_value.content = b'BEGIN:VCALENDAR\n...END:VCALENDAR'
 
+        ics_url = 'https://example.com/birthdays.ics'
         ics_content = download_ics(ics_url)
+        mock_get.assert_called_once_with(ics_url, stream=True)
+        mock_get.return_value.close.assert_called_once()
         self.assertIsNotNone(ics_content)
         self.assertTrue(ics_content.startswith(b'BEGIN:VCALENDAR'))
         self.assertTrue(ics_content.endswith(b'END:VCALENDAR'))
 
+    @patch('birthdaybot.http_session.get')
+    def test_download_ics_rejects_non_calendar_content_type(self, mock_get):
+        mock_get.return_value.headers = {'Content-Type': 'text/html'}
+
+        with self.assertRaises(ValueError):
+            download_ics('https://example.com/birthdays.ics')
+        # The response is still closed so its connection goes back to the pool
+        mock_get.return_value.close.assert_called_once()
+
+    @patch('birthdaybot.Server')
+    @patch('birthdaybot.Connection')
+    def test_verify_people_in_ldap_uses_single_search(self, mock_connection, mock_server):
+        def ldap_entry(uid, suspended):
+            entry = MagicMock()
+            entry.__contains__.side_effect = frozenset(('uid', 'suspended')).__contains__
+            entry.uid.values = [uid]
+            entry.suspended.value = suspended
+            return entry
+
+        conn = mock_connection.return_value
+        conn.entries = [ldap_entry('john.doe', 'False'), ldap_entry('jane.smith', 'True')]
+
+        active = verify_people_in_ldap(['John Doe', 'Jane Smith', 'Bob Jones', 'J*ne (x)'])
+        self.assertEqual(active, {'John Doe'})
+        conn.search.assert_called_once()
+        # Filter metacharacters from the calendar name are escaped, not passed through as wildcards
+        self.assertEqual(conn.search.call_args[0][1],
+                         '(|(uid=john.doe)(uid=jane.smith)(uid=bob.jones)(uid=j\\2ane.\\28x\\29))')
+
+    def test_iter_vevents_matches_icalendar(self):
+        ics_content = (
+            b'BEGIN:VCALENDAR\r\n'
+            b'BEGIN:VEVENT\r\n'
+            b'DTSTART;VALUE=DATE:20240315\r\n'
+            b'SUMMARY:John Doe - Birth\r\n day\r\n'
+            b'BEGIN:VALARM\r\n'
+            b'SUMMARY:Reminder\r\n'
+            b'END:VALARM\r\n'
+            b'END:VEVENT\r\n'
+            b'BEGIN:VEVENT\r\n'
+            b'DTSTART;TZID=America/Chicago:20240316T090000\r\n'
+            b'SUMMARY;ALTREP="http://example.com/a:b":Smith\\, Jane - Birthday\r\n'
+            b'END:VEVENT\r\n'
+            b'END:VCALENDAR\r\n'
+        )
+        expected = [(date(2024, 3, 15), 'John Doe - Birthday'), (date(2024, 3, 16), 'Smith, Jane - Birthday')]
+        self.assertEqual(list(iter_vevents(ics_content)), expected)
+        self.assertEqual(list(iter_vevents_with_icalendar(ics_content)), expected)
+        self.assertEqual(list(iter_vevents(ics_content, date(2024, 3, 16))), expected[1:])
+
+    def test_get_events_for_date_builds_greetings(self):
+        def vevent(summary, dtstart=b'DTSTART;VALUE=DATE:20240315\r\n'):
+            return b'BEGIN:VEVENT\r\n' + dtstart + b'SUMMARY:' + summary + b'\r\nEND:VEVENT\r\n'
+
+        ics_content = (
+            b'BEGIN:VCALENDAR\r\n'
+            + vevent(b'John Doe - Birthday')
+            + vevent(b'John Doe - Birthday')  # duplicate occurrence of the same person
+            + vevent(b'Team Lunch')  # no dash, not a birthday
+            + vevent(b'Jane Smith - Birthday', dtstart=b'')  # no DTSTART
+            + vevent(b'Bob Jones - Birthday')  # not active in LDAP
+            + vevent(b'Alice Brown - Birthday', dtstart=b'DTSTART;VALUE=DATE:20240316\r\n')
+            + vevent(b'Carol White - Birthday')
+            + b'END:VCALENDAR\r\n'
+        )
+        expected = [":birthday: Happy Birthday John Doe! :tada:", ":birthday: Happy Birthday Carol White! :tada:"]
+
+        for fallback in (False, True):
+            with self.subTest(icalendar_fallback=fallback), \
+                    patch('birthdaybot.verify_people_in_ldap',
+                          side_effect=lambda names: set(names) - {'Bob Jones'}) as mock_verify, \
+                    patch('birthdaybot.iter_vevents',
+                          side_effect=ValueError('unsupported') if fallback else iter_vevents):
+                self.assertEqual(get_events_for_date(ics_content, date(2024, 3, 15)), expected)
+                mock_verify.assert_called_once_with(['John Doe', 'Bob Jones', 'Carol White'])
+
+    @patch('birthdaybot.http_session.post')
+    def test_post_to_slack_batches_messages_into_blocks(self, mock_post):
+        post_to_slack('https://hooks.slack.com/x', ['Happy Birthday A', 'Happy Birthday B'])
+        mock_post.assert_called_once_with('https://hooks.slack.com/x', json={
+            'text': 'Happy Birthday A\nHappy Birthday B',
+            'blocks': [
+                {'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'Happy Birthday A'}},
+                {'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'Happy Birthday B'}},
+            ],
+        })
+
+        mock_post.reset_mock()
+        post_to_slack('https://hooks.slack.com/x', [f'Message {i}' for i in range(50)])
+        self.assertEqual(mock_post.call_count, 1)
+
+        # Slack allows at most 50 blocks per message, so the 51st spills into a second post
+        mock_post.reset_mock()
+        post_to_slack('https://hooks.slack.com/x', [f'Message {i}' for i in range(51)])
+        self.assertEqual(mock_post.call_count, 2)
+        first, second = (call.kwargs['json'] for call in mock_post.call_args_list)
+        self.assertEqual(len(first['blocks']), 50)
+        self.assertEqual(second, {
+            'text': 'Message 50',
+            'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'Message 50'}}],
+        })
+
     # Additional tests can be added here for other functions...
 
 if __name__ == '__main__':
-    ics_url = os.getenv('ICS_URL')
-    if not ics_url:
-        raise ValueError("ICS URL not provided. Set the ICS_URL environment variable.")
     unittest.main()
 